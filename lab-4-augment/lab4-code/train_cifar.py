@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
+import contextlib
+import copy
+import tempfile
 import time
 from multiprocessing import cpu_count
-from typing import Union, NamedTuple
+from typing import Optional, Union, NamedTuple
 
 import torch
 import torch.backends.cudnn
@@ -9,12 +12,11 @@ import torchvision
 import numpy as np
 from torch import nn, optim
 from torch.nn import functional as f
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import torchvision.datasets
 from torch.optim.optimizer import Optimizer
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from torch.utils.tensorboard import SummaryWriter
-from torchvision import transforms
-from torchvision.transforms import RandomHorizontalFlip
 
 import argparse
 from pathlib import Path
@@ -84,30 +86,30 @@ if torch.cuda.is_available():
 else:
     DEVICE = torch.device("cpu")
 
+# torch.inference_mode only exists from PyTorch 1.9, older versions get no_grad
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
 
 def main(args):
-    augmentations = []
-    if args.isHFlip:
-        augmentations.append(transforms.RandomHorizontalFlip())
-    if args.brightness > 0:
-        augmentations.append(transforms.ColorJitter(brightness=args.brightness))
-    if args.reflectionPadding > 0:
-        augmentations.append(transforms.Pad(padding=args.reflectionPadding, padding_mode='reflect'))
-    augmentations.append(transforms.ToTensor())
-    transform = transforms.Compose(augmentations)
     args.dataset_root.mkdir(parents=True, exist_ok=True)
-    train_dataset = torchvision.datasets.CIFAR10(
-        args.dataset_root, train=True, download=True, transform=transform
+    train_dataset = TensorCIFAR10(
+        torchvision.datasets.CIFAR10(args.dataset_root, train=True, download=True)
     )
-    test_dataset = torchvision.datasets.CIFAR10(
-        args.dataset_root, train=False, download=False, transform=transforms.ToTensor()
+    test_dataset = TensorCIFAR10(
+        torchvision.datasets.CIFAR10(args.dataset_root, train=False, download=False)
     )
+    # Keep workers alive between epochs and let them stage a few batches ahead.
+    # Both options are only valid when loading happens in worker processes.
+    worker_kwargs = {}
+    if args.worker_count > 0:
+        worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4}
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         shuffle=True,
         batch_size=args.batch_size,
         pin_memory=True,
         num_workers=args.worker_count,
+        **worker_kwargs,
     )
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
@@ -115,6 +117,7 @@ def main(args):
         batch_size=args.batch_size,
         num_workers=args.worker_count,
         pin_memory=True,
+        **worker_kwargs,
     )
 
     model = CNN(height=32, width=32, channels=3, class_count=10, dropout=args.dropout)
@@ -132,7 +135,16 @@ def main(args):
         flush_secs=5
     )
     trainer = Trainer(
-        model, train_loader, test_loader, criterion, optimizer, summary_writer, DEVICE
+        model,
+        train_loader,
+        test_loader,
+        criterion,
+        optimizer,
+        summary_writer,
+        DEVICE,
+        hflip=args.isHFlip,
+        brightness=args.brightness,
+        reflection_padding=args.reflectionPadding,
     )
 
     trainer.train(
@@ -145,6 +157,27 @@ def main(args):
     summary_writer.close()
 
 
+class TensorCIFAR10(Dataset):
+    """CIFAR-10 held in memory as a single uint8 tensor.
+
+    Avoids decoding a PIL image and running ``ToTensor`` for every sample on every
+    epoch. Samples are returned as raw uint8 so batches cost a quarter of the
+    bandwidth to transfer; the ``Trainer`` converts them to floats in [0, 1] and
+    augments them on the device.
+    """
+
+    def __init__(self, dataset: torchvision.datasets.CIFAR10):
+        # dataset.data is a (N, H, W, C) uint8 array, we want (N, C, H, W)
+        self.data = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+        self.targets = torch.tensor(dataset.targets, dtype=torch.int64)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, index: int):
+        return self.data[index], self.targets[index]
+
+
 class CNN(nn.Module):
     def __init__(self, height: int, width: int, channels: int, class_count: int, dropout: float):
         super().__init__()
@@ -174,6 +207,8 @@ class CNN(nn.Module):
         # TASK 3-1: Define the second pooling layer
         self.pool2 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
         # TASK 5-1: Define the first FC layer and initialise its parameters
+        # Both dimensions are multiples of 8, so under fp16 autocast this GEMM runs
+        # on Tensor Cores; keep that in mind if you resize it.
         self.fc1 = nn.Linear(4096, 1024)
         self.batchFc = nn.BatchNorm1d(num_features=1024)
         self.initialise_layer(self.fc1)
@@ -187,10 +222,10 @@ class CNN(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
 
     def forward(self, images: torch.Tensor) -> torch.Tensor:
-        x = f.relu(self.batch1(self.conv1(images)))
+        x = f.relu(self.batch1(self.conv1(images)), inplace=True)
         x = self.pool1(x)
         # TASK 2-2: Pass x through the second convolutional layer
-        x = f.relu(self.batch2(self.conv2(x)))
+        x = f.relu(self.batch2(self.conv2(x)), inplace=True)
         # TASK 3-2: Pass x through the second pooling layer
         x = self.pool2(x)
         # TASK 4: Flatten the output of the pooling layer, so it is of shape
@@ -203,6 +238,19 @@ class CNN(nn.Module):
         x = self.fc2(self.dropout(x))
         return x
 
+    def fuse_for_eval(self) -> "CNN":
+        """Fold the conv batch norms into the preceding convolutions.
+
+        Only valid in eval mode, where batch norm is a fixed affine transform. The
+        fused model can't be trained any further, so call this on a copy.
+        """
+        assert not self.training
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.batch1)
+        self.batch1 = nn.Identity()
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.batch2)
+        self.batch2 = nn.Identity()
+        return self
+
     @staticmethod
     def initialise_layer(layer):
         if hasattr(layer, "bias"):
@@ -221,8 +269,17 @@ class Trainer:
         optimizer: Optimizer,
         summary_writer: SummaryWriter,
         device: torch.device,
+        hflip: bool = False,
+        brightness: float = 0,
+        reflection_padding: int = 0,
     ):
-        self.model = model.to(device)
+        # channels_last (NHWC) lets cuDNN pick its fast convolution kernels
+        self.model = model.to(device, memory_format=torch.channels_last)
+        # Compile a separate handle that shares self.model's parameters, so that
+        # validate() can still copy and fuse the plain CNN
+        self.compiled_model = self.model
+        if hasattr(torch, "compile") and device.type == "cuda":
+            self.compiled_model = torch.compile(self.model, mode="max-autotune")
         self.device = device
         self.train_loader = train_loader
         self.val_loader = val_loader
@@ -230,6 +287,18 @@ class Trainer:
         self.optimizer = optimizer
         self.summary_writer = summary_writer
         self.step = 0
+        self.hflip = hflip
+        self.brightness = brightness
+        self.reflection_padding = reflection_padding
+        # Mixed precision only pays off (and is only supported for fp16) on the GPU
+        self.use_amp = device.type == "cuda"
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+        # Host timestamps don't mean much for asynchronous GPU work, so time the
+        # step with CUDA events there
+        if device.type == "cuda":
+            self.step_start_event = torch.cuda.Event(enable_timing=True)
+            self.step_end_event = torch.cuda.Event(enable_timing=True)
+        self.step_start_time = 0.
 
     def train(
         self,
@@ -239,67 +308,147 @@ class Trainer:
         log_frequency: int = 5,
         start_epoch: int = 0
     ):
+        def is_reported(step: int) -> bool:
+            return ((step + 1) % log_frequency) == 0 or ((step + 1) % print_frequency) == 0
+
         self.model.train()
         for epoch in range(start_epoch, epochs):
-            self.model.train()
             data_load_start_time = time.time()
             for batch, labels in self.train_loader:
-                batch = batch.to(self.device)
-                labels = labels.to(self.device)
-                data_load_end_time = time.time()
-
-                # TASK 1: Compute the forward pass of the model, print the output shape
-                #         and quit the program
-                logits = self.model.forward(batch)
-
-                # TASK 7: Rename `output` to `logits`, remove the output shape printing
-                #         and get rid of the `import sys; sys.exit(1)`
-
-                # TASK 9: Compute the loss using self.criterion and
-                #         store it in a variable called `loss`
-                loss = self.criterion(logits, labels)
+                # Only pay for timing on the steps we log or print
+                reported = is_reported(self.step)
+                # The first compiled step includes compilation, which would swamp its
+                # timings, so it's reported without any
+                compiling = self.step == 0 and self.compiled_model is not self.model
+                timed = reported and not compiling
+                data_load_time = step_time = None
+                batch = batch.to(
+                    self.device, non_blocking=True, memory_format=torch.channels_last
+                ).float().div_(255.)
+                labels = labels.to(self.device, non_blocking=True)
+                batch = self.augment(batch)
+                if timed:
+                    data_load_end_time = time.time()
+                    self.start_step_timer()
+
+                with self.autocast():
+                    # TASK 1: Compute the forward pass of the model, print the output shape
+                    #         and quit the program
+                    logits = self.compiled_model(batch)
+
+                    # TASK 7: Rename `output` to `logits`, remove the output shape printing
+                    #         and get rid of the `import sys; sys.exit(1)`
+
+                    # TASK 9: Compute the loss using self.criterion and
+                    #         store it in a variable called `loss`
+                    loss = self.criterion(logits, labels)
 
                 # TASK 10: Compute the backward pass
-                loss.backward()
+                self.scaler.scale(loss).backward()
 
                 # TASK 12: Step the optimizer and then zero out the gradient buffers.
-                self.optimizer.step()
-                self.optimizer.zero_grad()
-
-                with torch.no_grad():
-                    preds = logits.argmax(-1)
-                    accuracy = compute_accuracy(labels, preds)
-
-                data_load_time = data_load_end_time - data_load_start_time
-                step_time = time.time() - data_load_end_time
-                if ((self.step + 1) % log_frequency) == 0:
-                    self.log_metrics(epoch, accuracy, loss, data_load_time, step_time)
-                if ((self.step + 1) % print_frequency) == 0:
-                    self.print_metrics(epoch, accuracy, loss, data_load_time, step_time)
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
+                if timed:
+                    step_time = self.stop_step_timer()
+                    data_load_time = data_load_end_time - data_load_start_time
+
+                if reported:
+                    # Batch accuracy is only needed on reported steps
+                    with inference_mode():
+                        preds = logits.argmax(-1)
+                        accuracy = compute_accuracy(labels, preds)
+                    # One explicit sync per reported step, the metric methods take floats
+                    loss_f = loss.item()
+                    acc_f = accuracy.item()
+                if reported and ((self.step + 1) % log_frequency) == 0:
+                    self.log_metrics(epoch, acc_f, loss_f, data_load_time, step_time)
+                if reported and ((self.step + 1) % print_frequency) == 0:
+                    self.print_metrics(epoch, acc_f, loss_f, data_load_time, step_time)
 
                 self.step += 1
-                data_load_start_time = time.time()
+                if is_reported(self.step):
+                    data_load_start_time = time.time()
 
             self.summary_writer.add_scalar("epoch", epoch, self.step)
             if ((epoch + 1) % val_frequency) == 0:
                 self.validate()
-                # self.validate() will put the model in validation mode,
-                # so we have to switch back to train mode afterwards
-                self.model.train()
 
-    def print_metrics(self, epoch, accuracy, loss, data_load_time, step_time):
+    def start_step_timer(self):
+        if self.device.type == "cuda":
+            self.step_start_event.record()
+        else:
+            self.step_start_time = time.time()
+
+    def stop_step_timer(self) -> float:
+        """Return the seconds elapsed since ``start_step_timer``.
+
+        On the GPU this waits for the step's kernels to finish, so only call it on
+        steps that are actually reported.
+        """
+        if self.device.type == "cuda":
+            self.step_end_event.record()
+            self.step_end_event.synchronize()
+            return self.step_start_event.elapsed_time(self.step_end_event) / 1000
+        return time.time() - self.step_start_time
+
+    def augment(self, batch: torch.Tensor) -> torch.Tensor:
+        """Apply the training augmentations to a whole batch on the device."""
+        batch_size = batch.size(0)
+        if self.hflip:
+            flip = torch.rand(batch_size, 1, 1, 1, device=batch.device) < 0.5
+            batch = torch.where(flip, torch.flip(batch, dims=[-1]), batch)
+        if self.brightness > 0:
+            # Same factor range as transforms.ColorJitter(brightness=...)
+            low = max(0., 1 - self.brightness)
+            high = 1 + self.brightness
+            factor = low + torch.rand(batch_size, 1, 1, 1, device=batch.device) * (high - low)
+            batch = batch.mul_(factor).clamp_(0, 1)
+        if self.reflection_padding > 0:
+            batch = f.pad(batch, [self.reflection_padding] * 4, mode="reflect")
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def autocast(self):
+        if not self.use_amp:
+            return contextlib.nullcontext()
+        # torch.cuda.amp (fp16 by default) rather than torch.autocast, which needs
+        # PyTorch 1.10+ and isn't in the pytorch module train_cifar.sh loads on BC4
+        return torch.cuda.amp.autocast()
+
+    def print_metrics(
+        self,
+        epoch: int,
+        accuracy: float,
+        loss: float,
+        data_load_time: Optional[float],
+        step_time: Optional[float],
+    ):
         epoch_step = self.step % len(self.train_loader)
+        timings = ""
+        if step_time is not None:
+            timings = (
+                f", data load time: "
+                f"{data_load_time:.5f}, "
+                f"step time: {step_time:.5f}"
+            )
         print(
                 f"epoch: [{epoch}], "
                 f"step: [{epoch_step}/{len(self.train_loader)}], "
                 f"batch loss: {loss:.5f}, "
-                f"batch accuracy: {accuracy * 100:2.2f}, "
-                f"data load time: "
-                f"{data_load_time:.5f}, "
-                f"step time: {step_time:.5f}"
+                f"batch accuracy: {accuracy * 100:2.2f}"
+                + timings
         )
 
-    def log_metrics(self, epoch, accuracy, loss, data_load_time, step_time):
+    def log_metrics(
+        self,
+        epoch: int,
+        accuracy: float,
+        loss: float,
+        data_load_time: Optional[float],
+        step_time: Optional[float],
+    ):
         self.summary_writer.add_scalar("epoch", epoch, self.step)
         self.summary_writer.add_scalars(
                 "accuracy",
@@ -308,40 +457,56 @@ class Trainer:
         )
         self.summary_writer.add_scalars(
                 "loss",
-                {"train": float(loss.item())},
+                {"train": loss},
                 self.step
         )
-        self.summary_writer.add_scalar(
-                "time/data", data_load_time, self.step
-        )
-        self.summary_writer.add_scalar(
-                "time/data", step_time, self.step
-        )
+        if step_time is not None:
+            self.summary_writer.add_scalar(
+                    "time/data", data_load_time, self.step
+            )
+            self.summary_writer.add_scalar(
+                    "time/step", step_time, self.step
+            )
 
     def validate(self):
-        results = {"preds": [], "labels": []}
-        total_loss = 0
-        self.model.eval()
+        example_count = len(self.val_loader.dataset)
+        # Pinned so predictions can be copied back asynchronously, batch by batch
+        all_preds = torch.empty(
+            example_count, dtype=torch.long, pin_memory=self.device.type == "cuda"
+        )
+        all_labels = torch.empty_like(all_preds)
+        offset = 0
+        # Accumulate on the device so we only sync once, after the loop
+        total_loss = torch.zeros((), device=self.device)
+        # Validate a fused copy so the training model's conv/bn parameters are untouched
+        model = copy.deepcopy(self.model).eval().fuse_for_eval()
+        model = model.to(memory_format=torch.channels_last)
 
         # No need to track gradients for validation, we're not optimizing.
-        with torch.no_grad():
+        with inference_mode():
             for batch, labels in self.val_loader:
-                batch = batch.to(self.device)
-                labels = labels.to(self.device)
-                logits = self.model(batch)
-                loss = self.criterion(logits, labels)
-                total_loss += loss.item()
-                preds = logits.argmax(dim=-1).cpu().numpy()
-                results["preds"].extend(list(preds))
-                results["labels"].extend(list(labels.cpu().numpy()))
-
-        accuracy = compute_per_class_accuracy(
-            np.array(results["labels"]), np.array(results["preds"])
-        )
+                n = labels.size(0)
+                # The labels are already on the CPU, so keep them before moving them over
+                all_labels[offset:offset + n] = labels
+                batch = batch.to(
+                    self.device, non_blocking=True, memory_format=torch.channels_last
+                ).float().div_(255.)
+                labels = labels.to(self.device, non_blocking=True)
+                with self.autocast():
+                    logits = model(batch)
+                    loss = self.criterion(logits, labels)
+                total_loss += loss.detach()
+                all_preds[offset:offset + n].copy_(logits.argmax(dim=-1), non_blocking=True)
+                offset += n
+        if self.device.type == "cuda":
+            # Make sure all the prediction copies have landed before reading them
+            torch.cuda.synchronize(self.device)
+
+        accuracy = compute_per_class_accuracy(all_labels.numpy(), all_preds.numpy())
         per_class_accuracy = [
            f"{i}:{accuracy[i]}" for i in range(len(accuracy))
         ]
-        average_loss = total_loss / len(self.val_loader)
+        average_loss = (total_loss / len(self.val_loader)).item()
 
         self.summary_writer.add_scalars(
                 "accuracy",
@@ -358,13 +523,19 @@ class Trainer:
 
 def compute_accuracy(
     labels: Union[torch.Tensor, np.ndarray], preds: Union[torch.Tensor, np.ndarray]
-) -> float:
+) -> Union[torch.Tensor, float]:
     """
     Args:
         labels: ``(batch_size, class_count)`` tensor or array containing example labels
         preds: ``(batch_size, class_count)`` tensor or array containing model prediction
+
+    Returns:
+        A 0-dim tensor on the same device as ``labels`` when given tensors, so the
+        training loop doesn't have to sync with the GPU every step, otherwise a float.
     """
     assert len(labels) == len(preds)
+    if isinstance(labels, torch.Tensor):
+        return (labels == preds).float().mean()
     return float((labels == preds).sum()) / len(labels)
 
 
@@ -372,12 +543,12 @@ def compute_per_class_accuracy(
     labels: Union[torch.Tensor, np.ndarray], preds: Union[torch.Tensor, np.ndarray]
 ) -> [float]:
     assert len(labels) == len(preds)
-    classes = np.zeros(len(np.unique(labels)))
-    f_v = np.zeros(len(classes))
-    for i in range(len(labels)):
-        f_v[labels[i]] += 1
-        if labels[i] == preds[i]:
-            classes[labels[i]] += 1
+    labels = np.asarray(labels)
+    preds = np.asarray(preds)
+    class_count = int(labels.max()) + 1
+    correct_mask = (labels == preds).astype(np.int64)
+    f_v = np.bincount(labels, minlength=class_count).astype(np.float64)
+    classes = np.bincount(labels, weights=correct_mask, minlength=class_count)
     return classes/f_v
 
 
@@ -403,14 +574,9 @@ def get_summary_writer_log_dir(args: argparse.Namespace) -> str:
         (f"_reflect={args.reflectionPadding}" if args.reflectionPadding > 0 else "") +
         f'_run_')
 
-    i = 0
-    tb_log_dir = args.log_dir / (tb_log_dir_prefix + str(i))
-    while i < 1000:
-        tb_log_dir = args.log_dir / (tb_log_dir_prefix + str(i))
-        if not tb_log_dir.exists():
-            return str(tb_log_dir)
-        i += 1
-    return str(tb_log_dir)
+    # mkdtemp atomically creates a fresh directory with a random suffix after the prefix
+    args.log_dir.mkdir(parents=True, exist_ok=True)
+    return tempfile.mkdtemp(prefix=tb_log_dir_prefix, dir=str(args.log_dir))
 
 
 if __name__ == "__main__":